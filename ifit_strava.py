@@ -3,7 +3,9 @@
 import bisect
 import click
 import collections
-import dateutil.parser
+import concurrent.futures
+import datetime
+import functools
 from flask import Flask, request
 import glob
 import http.cookiejar
@@ -11,66 +13,115 @@ import logging
 import os
 import re
 import requests
+import requests.adapters
+import shutil
 import stravalib
 import sys
-import tcxparser
+import tempfile
 import threading
 import time
+import xml.etree.ElementTree as ET
 import yaml
 
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    # libyaml not available, fall back to the pure python implementation
+    from yaml import SafeDumper, SafeLoader
+
 _AUTH_TIMEOUT = 60
+_CHECK_HEAD_SIZE = 512
+_CHECK_TAIL_SIZE = 256
 _MAX_PAGES = 10
 _MIN_WORKOUT_SIZE = 1024
+_PARSE_CHUNKSIZE = 16
+_POOL_MAXSIZE = 8
+_DOWNLOAD_WORKERS = _POOL_MAXSIZE
 _SCOPE = ['activity:read', 'activity:write']
+_SEARCH_WINDOW = 24 * 60 * 60
+_STRAVA_CACHE_OVERLAP = 7 * 24 * 60 * 60
+_TCX_DOCUMENT_RE = re.compile(rb'<TrainingCenterDatabase.*</TrainingCenterDatabase>', re.DOTALL)
+_TCX_NS = '{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}'
+_UPLOAD_WORKERS = 3
 _WORKOUT_LINK_RE = re.compile(r'href="/workout/\w+/(\w+)"')
+_WORKOUT_META_CACHE = '.meta_cache.yaml'
 _WORKOUT_TCX_URL = "https://www.ifit.com/workout/export/tcx/"
 _WORKOUTS_URL = "https://www.ifit.com/me/workouts"
 
 Workout = collections.namedtuple('Workout', 'workout_id started_at duration notes tcx_file')
 
 
-def _get_workouts(url, cj):
-    r = requests.get(url, cookies=cj)
-    workouts = _WORKOUT_LINK_RE.findall(r.text)
-    return workouts
+def _create_session(cj=None):
+    '''Create a requests session with a connection pool, so that repeated requests to the same host reuse connections
+    (HTTP keep-alive) rather than paying for a new TCP+TLS handshake each time.'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=_POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    if cj is not None:
+        session.cookies = cj
+    return session
+
+
+def _get_workouts(url, session):
+    r = session.get(url)
+    r.raise_for_status()
+    return _WORKOUT_LINK_RE.findall(r.text)
 
 
-def _check_workout(data):
-    if not data.startswith("<?xml "):
+def _check_workout(head, tail):
+    '''Check the start and end of a workout look like a complete TCX document.'''
+    if not head.startswith(b"<?xml "):
         logging.error("Workout doesn't look like an XML document")
         return False
-    if data.find("<TrainingCenterDatabase") == -1 or data.find("</TrainingCenterDatabase>") == -1:
+    if _TCX_DOCUMENT_RE.search(head + tail) is None:
         logging.error("Workout doesn't look like a complete TCX document")
         return False
     return True
 
 
 def _check_workout_file(filename):
-    with open(filename, 'r') as f:
-        return _check_workout(f.read())
+    # only the head and tail are needed, so avoid reading the whole file
+    with open(filename, 'rb') as f:
+        head = f.read(_CHECK_HEAD_SIZE)
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(size - _CHECK_TAIL_SIZE, 0))
+        tail = f.read()
+    return _check_workout(head, tail)
 
 
-def _download_workout(workout_id, path, cj):
+def _download_workout(workout_id, path, session):
     filename = os.path.join(path, workout_id)
     if os.path.exists(filename) and _check_workout_file(filename):
-        logging.debug(f"Workout {workout_id} already downloaded at {filename} and looks ok")
+        logging.debug("Workout %s already downloaded at %s and looks ok", workout_id, filename)
     else:
         url = _WORKOUT_TCX_URL + workout_id
         logging.info(f"Saving workout {workout_id} to {filename}")
-        r = requests.get(url, cookies=cj)
-        with open(filename, 'w') as f:
-            f.write(r.text)
+        with session.get(url, stream=True) as r:
+            r.raise_for_status()
+            # undo any transfer compression, but otherwise write the bytes through as-is
+            r.raw.decode_content = True
+            # write to a temporary file first so an interrupted download can't
+            # leave a truncated workout behind (the leading '.' keeps it out of
+            # the workout glob)
+            with tempfile.NamedTemporaryFile(dir=path, prefix='.', delete=False) as f:
+                try:
+                    shutil.copyfileobj(r.raw, f)
+                except BaseException:
+                    f.close()
+                    os.remove(f.name)
+                    raise
+            os.replace(f.name, filename)
 
 
 def _load_config(config_file):
     with open(config_file, 'r') as f:
-        cfg = yaml.load(f, Loader=yaml.FullLoader)
+        cfg = yaml.load(f, Loader=SafeLoader)
     return cfg
 
 
 def _write_config(config_file, data):
     with open(config_file, 'w') as f:
-        yaml.dump(data, f)
+        yaml.dump(data, f, Dumper=SafeDumper)
 
 
 def _authorise(client, client_id, client_secret, redirect_uri, auth_port):
@@ -93,7 +144,7 @@ def _authorise(client, client_id, client_secret, redirect_uri, auth_port):
 
     @app.route('/authorised')
     def strava_authorised():
-        logging.debug(f"Request args: {dict(request.args.items())}")
+        logging.debug("Request args: %s", dict(request.args.items()))
         error = request.args.get('error')
         if error is not None:
             raise RuntimeError(f"Received error callback from Strava: {error}")
@@ -104,7 +155,7 @@ def _authorise(client, client_id, client_secret, redirect_uri, auth_port):
             raise RuntimeError(f"Didn't get all expected permissions ({_SCOPE}) in scope response ({scope})")
 
         response = client.exchange_code_for_token(client_id=client_id, client_secret=client_secret, code=code)
-        logging.debug(f"exchange_code_for_token response: {response}")
+        logging.debug("exchange_code_for_token response: %s", response)
 
         app.config['strava_token_response'] = response
 
@@ -125,162 +176,244 @@ def _authorise(client, client_id, client_secret, redirect_uri, auth_port):
 def _strava_upload(workout, strava, gear_id=None):
     logging.info(f"Uploading {workout}")
     # TODO: rate limiting
-    upload = strava.upload_activity(activity_file=open(workout.tcx_file, 'r'),
-                                    name=workout.notes,
-                                    description="iFit virtual treadmill run",
-                                    activity_type='VirtualRun',
-                                    data_type='tcx')
+    with open(workout.tcx_file, 'rb') as f:
+        upload = strava.upload_activity(activity_file=f,
+                                        name=workout.notes,
+                                        description="iFit virtual treadmill run",
+                                        activity_type='VirtualRun',
+                                        data_type='tcx')
     activity = upload.wait()
     url = f"https://www.strava.com/activities/{activity.id}"
     logging.info(f"Uploaded to {url}")
     if gear_id is not None:
-        logging.debug(f"Updating activity with gear_id {gear_id}")
+        logging.debug("Updating activity with gear_id %s", gear_id)
         strava.update_activity(activity.id, gear_id=gear_id)
+    return activity
+
+
+def _add_strava_activities(strava_cache, activities):
+    '''Merge Strava activities into the cache, keeping it sorted by start time.'''
+    merged = dict(zip(strava_cache['ids'], zip(strava_cache['start_times'], strava_cache['durations'])))
+    for a in activities:
+        merged[a.id] = (a.start_date.timestamp(), a.elapsed_time.total_seconds())
+    ids = sorted(merged, key=lambda i: merged[i][0])
+    strava_cache['ids'] = ids
+    strava_cache['start_times'] = [merged[i][0] for i in ids]
+    strava_cache['durations'] = [merged[i][1] for i in ids]
+
+
+def _get_strava_activities(strava, athlete_id, after, cache_file):
+    '''Get the ids, start times and durations of Strava activities started after a given time.
+
+    Times are in seconds (since the epoch for start times), as used by
+    find_similar_activities. The activities are cached in cache_file, so on
+    subsequent runs only activities started since the last fetch need to be
+    fetched from Strava. In case activities were uploaded a while after they
+    started, the fetch overlaps the previous one by _STRAVA_CACHE_OVERLAP
+    seconds. Delete the cache file to force everything to be fetched again
+    (e.g. after deleting activities on Strava).
+    '''
+    strava_cache = _load_config(cache_file) if os.path.exists(cache_file) else None
+    if strava_cache is None or strava_cache['athlete_id'] != athlete_id or strava_cache['after'] > after:
+        logging.debug("Strava activity cache %s missing or not applicable, fetching all activities", cache_file)
+        strava_cache = {
+            'athlete_id': athlete_id,
+            'after': after,
+            'fetched_at': None,
+            'ids': [],
+            'start_times': [],
+            'durations': [],
+        }
+
+    fetch_after = after
+    if strava_cache['fetched_at'] is not None:
+        fetch_after = max(after, strava_cache['fetched_at'] - _STRAVA_CACHE_OVERLAP)
+    fetched_at = time.time()
+
+    activities = strava.get_activities(after=datetime.datetime.fromtimestamp(fetch_after, datetime.timezone.utc))
+    _add_strava_activities(strava_cache, activities)
+    strava_cache['fetched_at'] = fetched_at
+    logging.debug("%d Strava activities after fetching those started after %s", len(strava_cache['ids']), fetch_after)
+
+    return strava_cache
+
+
+def _extract_tcx_meta(tcx_file):
+    '''Extract the start time, duration (in seconds) and notes of the first activity in a TCX file.
+
+    The start time is that of the first lap and the duration is the total over
+    all laps. Rather than parsing the whole document, this stops as soon as the
+    activity's notes (which follow its laps) or the end of the activity are
+    reached, and discards trackpoints as it goes.
+    '''
+    started_at = None
+    duration = 0.0
+    notes = ''
+    in_lap = False
+    for event, element in ET.iterparse(tcx_file, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == _TCX_NS + 'Lap':
+                in_lap = True
+                if started_at is None:
+                    started_at = element.get('StartTime')
+        elif element.tag == _TCX_NS + 'Lap':
+            in_lap = False
+        elif element.tag == _TCX_NS + 'TotalTimeSeconds' and in_lap:
+            duration += float(element.text)
+        elif element.tag == _TCX_NS + 'Trackpoint':
+            element.clear()
+        elif element.tag == _TCX_NS + 'Notes' and not in_lap:
+            notes = element.text or ''
+            break
+        elif element.tag == _TCX_NS + 'Activity':
+            break
+    return started_at, duration, notes
 
 
 def _get_ifit_workouts(workout_dir):
-    workouts = []
+    '''Get the workouts saved in workout_dir, sorted by start time.
+
+    The metadata extracted from each workout file is cached in
+    _WORKOUT_META_CACHE in workout_dir, keyed by the file's modification time
+    and size, so only new or changed files need to be parsed.
+    '''
+    cache_file = os.path.join(workout_dir, _WORKOUT_META_CACHE)
+    meta_cache = (_load_config(cache_file) if os.path.exists(cache_file) else None) or {}
+
+    # rebuild the cache from the files present, which prunes any deleted workouts
+    new_meta_cache = {}
+    to_parse = []
     for workout_file in glob.glob(os.path.join(workout_dir, '*')):
-        tcx = tcxparser.TCXParser(workout_file)
-        workout = Workout(workout_id=os.path.basename(workout_file),
-                          started_at=tcx.started_at,
-                          duration=tcx.duration,
-                          notes=tcx.activity_notes,
-                          tcx_file=workout_file)
-        logging.debug(f"Workout: {workout}")
+        workout_id = os.path.basename(workout_file)
+        st = os.stat(workout_file)
+        meta = meta_cache.get(workout_id)
+        if meta is not None and meta['mtime_ns'] == st.st_mtime_ns and meta['size'] == st.st_size:
+            new_meta_cache[workout_id] = meta
+        else:
+            new_meta_cache[workout_id] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+            to_parse.append(workout_file)
+
+    if len(to_parse) != 0:
+        logging.debug("Parsing %d new or changed workout files", len(to_parse))
+        if len(to_parse) <= _PARSE_CHUNKSIZE:
+            # usually only a few new workouts, which isn't worth starting processes for
+            metas = [_extract_tcx_meta(workout_file) for workout_file in to_parse]
+        else:
+            # parsing is CPU bound and each file is independent, so spread it
+            # across processes, but don't start more than there are chunks to parse
+            max_workers = min(-(-len(to_parse) // _PARSE_CHUNKSIZE), os.cpu_count() or 1)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                metas = list(executor.map(_extract_tcx_meta, to_parse, chunksize=_PARSE_CHUNKSIZE))
+        for workout_file, (started_at, duration, notes) in zip(to_parse, metas):
+            new_meta_cache[os.path.basename(workout_file)].update(started_at=started_at,
+                                                                  duration=duration,
+                                                                  notes=notes)
+
+    if new_meta_cache != meta_cache:
+        _write_config(cache_file, new_meta_cache)
+
+    workouts = []
+    for workout_id, meta in new_meta_cache.items():
+        workout = Workout(workout_id=workout_id,
+                          started_at=meta['started_at'],
+                          duration=meta['duration'],
+                          notes=meta['notes'],
+                          tcx_file=os.path.join(workout_dir, workout_id))
+        logging.debug("Workout: %s", workout)
         workouts.append(workout)
     workouts.sort(key=lambda x: x.started_at)
     return workouts
 
 
-def _get_start_time_delta(workout, strava_activity):
-    workout_start_time = dateutil.parser.parse(workout.started_at)
-    return abs((strava_activity.start_date - workout_start_time).total_seconds())
+@functools.lru_cache(maxsize=4096)
+def _parse_iso(timestamp):
+    # iFit times look like 2020-06-01T06:36:58.517Z, and fromisoformat only
+    # accepts a trailing Z from python 3.11
+    return datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
 
 
-def is_similar_activity(workout, strava_activity):
+def _is_similar(workout_start_time, workout_duration, start_time, duration):
+    # all arguments are in seconds (start times since the epoch) so this is
+    # just arithmetic on floats, rather than on datetime/timedelta objects
+    #
     # started within 10 mins of each other and duration is no more than 30s different
-    start_time_delta = _get_start_time_delta(workout, strava_activity)
-    duration_delta = abs(workout.duration - strava_activity.elapsed_time.total_seconds())
-    return start_time_delta < 10 * 60 and duration_delta < 30
+    return abs(start_time - workout_start_time) < 10 * 60 and abs(workout_duration - duration) < 30
 
 
-def _log_debug_slice(workout, strava_activities, start_times, index, size):
-    start_index = index - size
-    end_index = index + 1 + size
-    if start_index < 0:
-        start_index = 0
-    if end_index > len(strava_activities):
-        end_index = len(strava_activities)
-    for i in range(start_index, end_index):
-        marker = '<<<' if i < index else '>>>' if i > index else '==='
-        logging.debug(f"{marker} {i}: {strava_activities[i]} {start_times[i]}")
-
+def is_similar_activity(workout, strava_activity):
+    return _is_similar(_parse_iso(workout.started_at).timestamp(), workout.duration,
+                       strava_activity.start_date.timestamp(), strava_activity.elapsed_time.total_seconds())
 
-def _search_near(workout, strava_activities, start_times, index):
-    '''Search for similar activities to workout from a given index in the list of activities.
 
-    index should be just to the left of the workout if it's in the list,
-    however since we're searching by time and the precision differs between
-    iFit and Strava (iFit has millisecond-level, Strava (or stravalib)
-    truncates to seconds), it's possible that the iFit workout time inserts
-    just after the time of the existing Strava representation of the same
-    workout. Hence we always search at least one to the left and right.
+def _index_activities(strava_activities):
+    '''Extract the start times (in seconds since the epoch) and durations (in seconds) of a list of Strava activities.
 
+    These are what the similarity search works on, so extracting them once up
+    front means they don't need to be recomputed from the activities for every
+    workout. This is also where the activities are checked to be sorted by
+    start time, which the search relies on.
     '''
-    similar_activities = []
-
-    # index could be off either end of the array if that's where the workout's
-    # time would sort to, so adjust it back
-    if index < 0:
-        index = 0
-    if index >= len(strava_activities):
-        index = len(strava_activities) - 1
-
-    left_index = index
-    right_index = index + 1
-
-    time_cutoff = 24 * 60 * 60
-    min_search_distance = 1
-
-    continue_left = True
-    continue_right = True
-    distance = 0
-
-    def _search(ii, left):
-        marker = 'left' if left else 'right'
-        logging.debug(f"Searching {marker} {ii} {start_times[ii]} {strava_activities[ii]}")
-        if is_similar_activity(workout, strava_activities[ii]):
-            logging.debug(f"Found similar activity going {marker} at {ii} {strava_activities[ii]}")
-            if left:
-                similar_activities.insert(0, strava_activities[ii])
-            else:
-                similar_activities.append(strava_activities[ii])
-
-    def _should_continue(ii, left):
-        if left:
-            return ii >= 0 and (distance < min_search_distance
-                                or _get_start_time_delta(workout, strava_activities[ii]) < time_cutoff)
-        else:
-            return ii < len(strava_activities) and (distance < min_search_distance or
-                                                    _get_start_time_delta(workout, strava_activities[ii]) < time_cutoff)
-
-    while continue_left or continue_right:
-        continue_left = _should_continue(left_index, left=True)
-        if continue_left:
-            _search(left_index, left=True)
-            left_index -= 1
-        continue_right = _should_continue(right_index, left=False)
-        if continue_right:
-            _search(right_index, left=False)
-            right_index += 1
-        distance += 1
+    start_times = [a.start_date.timestamp() for a in strava_activities]
+    assert all(a <= b for a, b in zip(start_times, start_times[1:]))
+    durations = [a.elapsed_time.total_seconds() for a in strava_activities]
+    return start_times, durations
 
-    return similar_activities
 
-
-def find_similar_activities(workout, strava_activities):
+def find_similar_activities(workout, strava_activities, start_times=None, durations=None):
     '''Find similar Strava activities to the given workout
 
-    TODO: this is over-complicated, something simpler would likely work fine!
-
-    This works by searching where the workout should be based on its start time
-    in the list of Strava activities (which is sorted by start time). Since
-    times can be off and sometimes there are some 'false starts' etc., it then
-    searches outwards from that index doing a fuzzy match based on start time
-    and duration (see is_similar_activity).
+    Since the Strava activities are sorted by start time, any activity similar
+    to the workout (see is_similar_activity) must be in the contiguous window
+    of activities starting within _SEARCH_WINDOW seconds of the workout. That
+    window is found by bisecting on start time and then each activity in it is
+    checked with a fuzzy match on start time and duration. Searching a wide window
+    rather than just around where the workout would sort copes with times
+    being off (e.g. iFit has millisecond precision, whereas Strava truncates
+    to seconds) and 'false starts' etc.
+
+    start_times and durations can be passed in from _index_activities to
+    avoid recomputing them when searching the same activities repeatedly. In
+    that case strava_activities can be anything indexed in parallel with them
+    (e.g. the activity ids from _get_strava_activities).
     '''
     assert len(strava_activities) > 0
 
-    start_times = [a.start_date for a in strava_activities]
-    assert start_times == sorted(start_times)
-    workout_start_time = dateutil.parser.parse(workout.started_at)
-    index = bisect.bisect_left(start_times, workout_start_time)
+    if start_times is None or durations is None:
+        start_times, durations = _index_activities(strava_activities)
+    workout_start_time = _parse_iso(workout.started_at).timestamp()
+    start_index = bisect.bisect_left(start_times, workout_start_time - _SEARCH_WINDOW)
+    end_index = bisect.bisect_right(start_times, workout_start_time + _SEARCH_WINDOW)
 
-    logging.debug(
-        f"Searching for similar activities to {workout} at index {index} in {len(strava_activities)} activities")
-    _log_debug_slice(workout, strava_activities, start_times, index, 2)
+    logging.debug("Searching for similar activities to %s at indices [%d, %d) in %d activities", workout, start_index,
+                  end_index, len(strava_activities))
 
-    return _search_near(workout, strava_activities, start_times, index)
+    return [
+        strava_activities[i] for i in range(start_index, end_index)
+        if _is_similar(workout_start_time, workout.duration, start_times[i], durations[i])
+    ]
 
 
 def _should_skip(workout, skip):
     if workout.duration < 3 * 60:
-        logging.debug(f"Skipping workout {workout} due to short duration")
+        logging.debug("Skipping workout %s due to short duration", workout)
         return True
     if workout.workout_id in skip:
-        logging.debug(f"Skipping workout {workout} due to being on skip list")
+        logging.debug("Skipping workout %s due to being on skip list", workout)
         return True
     return False
 
 
 @click.group(chain=True)
 @click.option('-c', '--config-file', default='config/config.yaml', help='Config file')
+@click.option('-s',
+              '--strava-cache-file',
+              default='config/strava_cache.yaml',
+              help='Strava activity cache file path (generated file)')
 @click.option('-t', '--token-file', default='config/token.yaml', help='Token file path (generated file)')
 @click.option('-v', '--verbose/--no-verbose', default=False, help='Enable verbose logging')
 @click.option('-w', '--workout-dir', default='workouts', help='Directory to save cached iFit workouts in')
 @click.pass_context
-def ifit_strava(ctx, config_file, token_file, verbose, workout_dir):
+def ifit_strava(ctx, config_file, strava_cache_file, token_file, verbose, workout_dir):
     ctx.ensure_object(dict)
 
     logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
@@ -288,6 +421,7 @@ def ifit_strava(ctx, config_file, token_file, verbose, workout_dir):
     logging.getLogger('urllib3').setLevel(logging.INFO)
 
     ctx.obj['config_file'] = config_file
+    ctx.obj['strava_cache_file'] = strava_cache_file
     ctx.obj['token_file'] = token_file
     ctx.obj['workout_dir'] = workout_dir
 
@@ -302,12 +436,18 @@ def download(ctx, cookies_file):
 
     cj = http.cookiejar.MozillaCookieJar()
     cj.load(cookies_file)
+    session = _create_session(cj)
 
-    workouts = list()
-    for i in range(1, _MAX_PAGES):
-        workouts.extend(_get_workouts(_WORKOUTS_URL + f"?page={i}", cj))
+    # a dict rather than a set to keep the workouts in the order they're listed
+    workouts = dict()
+    for i in range(1, _MAX_PAGES + 1):
+        page_workouts = [w for w in _get_workouts(_WORKOUTS_URL + f"?page={i}", session) if w not in workouts]
+        if len(page_workouts) == 0:
+            logging.debug("No new workouts on page %d, stopping", i)
+            break
+        workouts.update(dict.fromkeys(page_workouts))
 
-    logging.debug(f"Found {len(workouts)} workouts")
+    logging.debug("Found %d workouts", len(workouts))
 
     if len(workouts) == 0:
         raise RuntimeError("Found 0 workouts, perhaps your cookies have expired?")
@@ -315,8 +455,21 @@ def download(ctx, cookies_file):
     if not os.path.exists(workout_dir):
         os.makedirs(workout_dir)
 
-    for workout_id in workouts:
-        _download_workout(workout_id, workout_dir, cj)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_DOWNLOAD_WORKERS) as executor:
+        futures = {
+            executor.submit(_download_workout, workout_id, workout_dir, session): workout_id
+            for workout_id in workouts
+        }
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logging.exception("Failed to download workout %s", futures[future])
+                failed.append(futures[future])
+
+    if len(failed) != 0:
+        raise RuntimeError(f"Failed to download {len(failed)} workouts: {failed}")
 
 
 @ifit_strava.command(help='Authenticate with strava')
@@ -360,7 +513,7 @@ def auth(ctx):
         token_config['refresh_token'] = refresh_response['refresh_token']
         token_config['expires_at'] = refresh_response['expires_at']
 
-    logging.debug(f"Saving token config to {ctx.obj['token_file']}")
+    logging.debug("Saving token config to %s", ctx.obj['token_file'])
     _write_config(ctx.obj['token_file'], token_config)
 
 
@@ -376,29 +529,55 @@ def upload(ctx):
         logging.error("Access token missing or expired")
         sys.exit(1)
 
-    strava = stravalib.Client()
+    strava = stravalib.Client(requests_session=_create_session())
     strava.access_token = token_config['access_token']
-    logging.debug(f"Using strava access token {strava.access_token}")
+    logging.debug("Using strava access token %s", strava.access_token)
 
     athlete = strava.get_athlete()
-    logging.debug(f"Strava athlete id {athlete.id}")
+    logging.debug("Strava athlete id %s", athlete.id)
 
     ifit_workouts = _get_ifit_workouts(workout_dir)
     earliest_workout_start = ifit_workouts[0].started_at
-    logging.debug(f"Earliest iFit workout started at {earliest_workout_start}")
+    logging.debug("Earliest iFit workout started at %s", earliest_workout_start)
+
+    strava_cache_file = ctx.obj['strava_cache_file']
+    strava_cache = _get_strava_activities(strava, athlete.id,
+                                          _parse_iso(earliest_workout_start).timestamp(), strava_cache_file)
+    _write_config(strava_cache_file, strava_cache)
 
-    strava_activities = list(strava.get_activities(after=earliest_workout_start))
+    skip = frozenset(config.get('skip') or ())
 
+    to_upload = []
     for workout in ifit_workouts:
-        if _should_skip(workout, config['skip']):
+        if _should_skip(workout, skip):
             continue
 
-        similar_activities = find_similar_activities(workout, strava_activities)
+        similar_activities = find_similar_activities(workout, strava_cache['ids'], strava_cache['start_times'],
+                                                     strava_cache['durations'])
 
         if len(similar_activities) != 0:
-            logging.debug(f"Skipping workout {workout} due to similar activities {similar_activities}")
+            logging.debug("Skipping workout %s due to similar activities %s", workout, similar_activities)
         else:
-            _strava_upload(workout, strava)
+            to_upload.append(workout)
+
+    # most of the time for an upload is spent waiting for Strava to process it,
+    # so overlap a few of them
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_UPLOAD_WORKERS) as executor:
+        futures = {executor.submit(_strava_upload, workout, strava): workout for workout in to_upload}
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                activity = future.result()
+            except Exception:
+                logging.exception("Failed to upload workout %s", futures[future])
+                failed.append(futures[future].workout_id)
+                continue
+            # record the upload, as it may have started too long ago to be refetched next time
+            _add_strava_activities(strava_cache, [activity])
+            _write_config(strava_cache_file, strava_cache)
+
+    if len(failed) != 0:
+        raise RuntimeError(f"Failed to upload {len(failed)} workouts: {failed}")
 
 
 if __name__ == '__main__':
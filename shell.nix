@@ -12,24 +12,6 @@ let
     };
   });
 
-  tcxparser = buildPythonPackage rec {
-    pname = "python-tcxparser";
-    version = "1.1.0";
-
-    src = fetchPypi {
-      inherit pname version;
-      sha256 = "1v868dcfxxjx2f3gkr14ldvq9093zjp7l0x4gbdfkb1lwj0fmzjz";
-    };
-
-    propagatedBuildInputs = [ lxml ];
-
-    meta = with lib; {
-      homepage = https://github.com/vkurup/python-tcxparser/;
-      description = "Simple parser for Garmin TCX files";
-      license = licenses.bsd2;
-    };
-  };
-
 in
   buildPythonPackage rec {
     name = "ifit_strava";
@@ -37,12 +19,10 @@ in
     propagatedBuildInputs = [ click
                               flask
                               flake8
-                              lxml
                               pytest
                               pyyaml
                               requests
                               stravalib_patched
-                              tcxparser
                               yapf
                             ];
   }
@@ -1,5 +1,7 @@
+from click.testing import CliRunner
 import datetime
 import dateutil.parser
+import io
 import pytest
 from unittest.mock import MagicMock
 
@@ -74,3 +76,233 @@ def test_find_similar_activities():
     # (it's really already the last element in the array, but the milliseconds
     # are different).
     assert ifit_strava.find_similar_activities(workout_1, [activity_1, activity_5]) == [activity_5]
+
+
+def test_check_workout_file(tmp_path):
+    def check(data):
+        workout_file = tmp_path / 'workout'
+        workout_file.write_bytes(data)
+        return ifit_strava._check_workout_file(workout_file)
+
+    assert check(b'<?xml version="1.0"?><TrainingCenterDatabase></TrainingCenterDatabase>')
+    assert check(b'<?xml version="1.0"?><TrainingCenterDatabase>' + b' ' * 10000 + b'</TrainingCenterDatabase>\n')
+    # not XML
+    assert not check(b'<html><body>Please log in</body></html>')
+    # truncated
+    assert not check(b'<?xml version="1.0"?><TrainingCenterDatabase>' + b' ' * 10000)
+
+
+def test_get_strava_activities(tmp_path):
+    cache_file = str(tmp_path / 'strava_cache.yaml')
+    after = dateutil.parser.parse('2020-05-01T00:00:00Z').timestamp()
+
+    activity_1 = MagicMock(id=1,
+                           start_date=dateutil.parser.parse('2020-06-01T06:36:58Z'),
+                           elapsed_time=datetime.timedelta(seconds=2613))
+    activity_2 = MagicMock(id=2,
+                           start_date=dateutil.parser.parse('2020-05-30T17:28:38Z'),
+                           elapsed_time=datetime.timedelta(seconds=2203))
+    strava = MagicMock()
+    strava.get_activities.return_value = [activity_2, activity_1]
+
+    strava_cache = ifit_strava._get_strava_activities(strava, 1234, after, cache_file)
+    assert strava_cache['ids'] == [2, 1]
+    assert strava_cache['start_times'] == [activity_2.start_date.timestamp(), activity_1.start_date.timestamp()]
+    assert strava_cache['durations'] == [2203, 2613]
+    assert strava.get_activities.call_args[1]['after'].timestamp() == after
+    ifit_strava._write_config(cache_file, strava_cache)
+
+    # only recent activities are fetched again and are merged into the cache
+    activity_3 = MagicMock(id=3,
+                           start_date=dateutil.parser.parse('2020-05-31T08:01:22Z'),
+                           elapsed_time=datetime.timedelta(seconds=3094))
+    strava.get_activities.return_value = [activity_3, activity_1]
+    strava_cache = ifit_strava._get_strava_activities(strava, 1234, after, cache_file)
+    assert strava_cache['ids'] == [2, 3, 1]
+    assert strava.get_activities.call_args[1]['after'].timestamp() > after
+
+    # cache for a different athlete is ignored
+    strava.get_activities.return_value = [activity_1]
+    strava_cache = ifit_strava._get_strava_activities(strava, 5678, after, cache_file)
+    assert strava_cache['ids'] == [1]
+    assert strava.get_activities.call_args[1]['after'].timestamp() == after
+
+
+_TCX = b'''<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+  <Activities>
+    <Activity Sport="Running">
+      <Id>2020-06-01T06:36:58.517Z</Id>
+      <Lap StartTime="2020-06-01T06:36:58.517Z">
+        <TotalTimeSeconds>1800</TotalTimeSeconds>
+        <Track>
+          <Trackpoint><Time>2020-06-01T06:36:58.517Z</Time></Trackpoint>
+        </Track>
+        <Notes>Lap notes</Notes>
+      </Lap>
+      <Lap StartTime="2020-06-01T07:06:58.517Z">
+        <TotalTimeSeconds>813.5</TotalTimeSeconds>
+      </Lap>
+      <Notes>Morning run</Notes>
+    </Activity>
+  </Activities>
+</TrainingCenterDatabase>
+'''
+
+
+def test_extract_tcx_meta(tmp_path):
+    workout_file = tmp_path / 'workout'
+    workout_file.write_bytes(_TCX)
+    assert ifit_strava._extract_tcx_meta(str(workout_file)) == ('2020-06-01T06:36:58.517Z', 2613.5, 'Morning run')
+
+    # no notes
+    workout_file.write_bytes(_TCX.replace(b'<Notes>Morning run</Notes>', b''))
+    assert ifit_strava._extract_tcx_meta(str(workout_file)) == ('2020-06-01T06:36:58.517Z', 2613.5, '')
+
+
+def test_get_ifit_workouts(tmp_path, monkeypatch):
+    # parse the initial files in a process pool, but the changed file below inline
+    monkeypatch.setattr(ifit_strava, '_PARSE_CHUNKSIZE', 1)
+    (tmp_path / 'workout_1').write_bytes(_TCX)
+    (tmp_path / 'workout_2').write_bytes(_TCX.replace(b'2020-06-01T', b'2020-05-31T'))
+
+    workouts = ifit_strava._get_ifit_workouts(str(tmp_path))
+    assert [w.workout_id for w in workouts] == ['workout_2', 'workout_1']
+    assert workouts[1] == ifit_strava.Workout(workout_id='workout_1',
+                                              started_at='2020-06-01T06:36:58.517Z',
+                                              duration=2613.5,
+                                              notes='Morning run',
+                                              tcx_file=str(tmp_path / 'workout_1'))
+
+    # unchanged files are read from the cache
+    cache_file = str(tmp_path / ifit_strava._WORKOUT_META_CACHE)
+    meta_cache = ifit_strava._load_config(cache_file)
+    meta_cache['workout_1']['notes'] = 'Cached run'
+    ifit_strava._write_config(cache_file, meta_cache)
+    assert ifit_strava._get_ifit_workouts(str(tmp_path))[1].notes == 'Cached run'
+
+    # changed files are parsed again and deleted files are dropped
+    (tmp_path / 'workout_1').write_bytes(_TCX.replace(b'Morning run', b'Late evening run'))
+    (tmp_path / 'workout_2').unlink()
+    workouts = ifit_strava._get_ifit_workouts(str(tmp_path))
+    assert [(w.workout_id, w.notes) for w in workouts] == [('workout_1', 'Late evening run')]
+    assert list(ifit_strava._load_config(cache_file)) == ['workout_1']
+
+
+def _workouts_page(*workout_ids):
+    return ''.join(f'<a href="/workout/abc/{w}">Workout</a>' for w in workout_ids)
+
+
+def test_download(tmp_path, monkeypatch):
+    cookies_file = tmp_path / 'cookies.txt'
+    cookies_file.write_text('# Netscape HTTP Cookie File\n')
+    workout_dir = tmp_path / 'workouts'
+
+    # pages 1 and 2 overlap, page 3 has nothing new so page 4 shouldn't be fetched
+    pages = {
+        1: _workouts_page('w1', 'w2'),
+        2: _workouts_page('w2', 'w3'),
+        3: _workouts_page('w3'),
+        4: _workouts_page('w4'),
+    }
+
+    def get(url, stream=False):
+        r = MagicMock()
+        if url.startswith(ifit_strava._WORKOUTS_URL):
+            r.text = pages[int(url.split('=')[-1])]
+        else:
+            r.__enter__.return_value.raw = io.BytesIO(_TCX)
+        return r
+
+    session = MagicMock()
+    session.get.side_effect = get
+    monkeypatch.setattr(ifit_strava, '_create_session', lambda cj: session)
+
+    result = CliRunner().invoke(ifit_strava.ifit_strava,
+                                ['-w', str(workout_dir), 'download', '--cookies-file',
+                                 str(cookies_file)])
+    assert result.exit_code == 0, result.output
+
+    urls = [c[0][0] for c in session.get.call_args_list]
+    assert urls[:3] == [ifit_strava._WORKOUTS_URL + f"?page={i}" for i in range(1, 4)]
+    assert sorted(urls[3:]) == [ifit_strava._WORKOUT_TCX_URL + w for w in ['w1', 'w2', 'w3']]
+    assert sorted(p.name for p in workout_dir.iterdir()) == ['w1', 'w2', 'w3']
+    assert (workout_dir / 'w1').read_bytes() == _TCX
+
+    # an error fetching a listing page fails rather than silently stopping
+    session.get.side_effect = None
+    session.get.return_value.raise_for_status.side_effect = ifit_strava.requests.HTTPError('503')
+    result = CliRunner().invoke(ifit_strava.ifit_strava,
+                                ['-w', str(workout_dir), 'download', '--cookies-file',
+                                 str(cookies_file)])
+    assert isinstance(result.exception, ifit_strava.requests.HTTPError)
+
+
+def test_download_workout_interrupted(tmp_path):
+    class InterruptedRaw(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell() != 0:
+                raise ConnectionResetError("Connection reset by peer")
+            return super().read(10)
+
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value.raw = InterruptedRaw(_TCX)
+
+    with pytest.raises(ConnectionResetError):
+        ifit_strava._download_workout('w1', str(tmp_path), session)
+    # neither the workout nor the temporary file is left behind
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_upload(tmp_path, monkeypatch):
+    config_file = tmp_path / 'config.yaml'
+    ifit_strava._write_config(str(config_file), {'skip': []})
+    token_file = tmp_path / 'token.yaml'
+    ifit_strava._write_config(str(token_file), {
+        'access_token': 'token',
+        'refresh_token': 'refresh',
+        'expires_at': 2**40,
+    })
+    strava_cache_file = tmp_path / 'strava_cache.yaml'
+
+    workout_dir = tmp_path / 'workouts'
+    workout_dir.mkdir()
+    # already on Strava
+    (workout_dir / 'workout_1').write_bytes(_TCX)
+    # not on Strava, uploads fine
+    (workout_dir / 'workout_2').write_bytes(_TCX.replace(b'2020-06-01T', b'2020-05-20T'))
+    # not on Strava, upload fails
+    (workout_dir / 'workout_3').write_bytes(_TCX.replace(b'2020-06-01T', b'2020-05-10T'))
+
+    activity_1 = MagicMock(id=1,
+                           start_date=dateutil.parser.parse('2020-06-01T06:36:58Z'),
+                           elapsed_time=datetime.timedelta(seconds=2613))
+    activity_2 = MagicMock(id=2,
+                           start_date=dateutil.parser.parse('2020-05-20T06:36:58Z'),
+                           elapsed_time=datetime.timedelta(seconds=2613))
+
+    def upload_activity(activity_file, **kwargs):
+        if activity_file.name.endswith('workout_3'):
+            raise RuntimeError("Upload failed")
+        uploader = MagicMock()
+        uploader.wait.return_value = activity_2
+        return uploader
+
+    strava = MagicMock()
+    strava.get_athlete.return_value = MagicMock(id=1234)
+    strava.get_activities.return_value = [activity_1]
+    strava.upload_activity.side_effect = upload_activity
+    monkeypatch.setattr(ifit_strava.stravalib, 'Client', lambda **kwargs: strava)
+
+    result = CliRunner().invoke(ifit_strava.ifit_strava, [
+        '-c', str(config_file), '-t', str(token_file), '-s', str(strava_cache_file), '-w', str(workout_dir), 'upload'
+    ])
+
+    # the failed upload doesn't stop the others, but is reported at the end
+    assert isinstance(result.exception, RuntimeError)
+    assert 'workout_3' in str(result.exception)
+    uploaded = sorted(c[1]['activity_file'].name for c in strava.upload_activity.call_args_list)
+    assert uploaded == [str(workout_dir / 'workout_2'), str(workout_dir / 'workout_3')]
+
+    # the successful upload is recorded in the cache
+    assert ifit_strava._load_config(str(strava_cache_file))['ids'] == [2, 1]